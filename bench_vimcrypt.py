@@ -0,0 +1,46 @@
+"""Benchmark vim_decrypt against the original per-character decrypter
+
+    python bench_vimcrypt.py [size-in-KB]
+"""
+
+import os
+import sys
+import time
+
+from vimcrypt import MAGIC, vim_encrypt, vim_decrypt, _ZipDecrypter
+
+
+def per_char_decrypt(data, key):
+    """vim_decrypt as it was before _ZipDecrypter.decrypt existed"""
+    zd = _ZipDecrypter(key)
+    return ''.join([zd(c) for c in data[len(MAGIC):]])
+
+
+def throughput(decrypt, data, key):
+    """Return (output, MB/s) of decrypt(data, key)"""
+    start = time.time()
+    text = decrypt(data, key)
+    elapsed = time.time() - start
+    return text, len(data) / elapsed / (1024 * 1024)
+
+
+def main():
+    size = 1024
+    if len(sys.argv) > 1:
+        size = int(sys.argv[1])
+    key = 'benchmark key'
+    text = os.urandom(size * 1024)
+    data = vim_encrypt(text, key)
+
+    expected, before = throughput(per_char_decrypt, data, key)
+    actual, after = throughput(vim_decrypt, data, key)
+    assert expected == text, 'per-character decrypt does not round-trip'
+    assert actual == expected, 'vim_decrypt output differs'
+
+    print 'decrypting %d KB' % size
+    print '  per-character: %6.2f MB/s' % before
+    print '  vim_decrypt:   %6.2f MB/s (%.1fx)' % (after, after / before)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""Local stand-in for the Dropbox public folder
+
+Serves the files of a corpus directory over HTTP, with an etag per file
+and 304 replies to conditional GETs, like dl.dropbox.com does. Pages can
+be served encrypted the way vim -x would have saved them.
+
+    python fake_dropbox.py CORPUS [--port 8081] [--key KEY --private a,b]
+"""
+
+import os
+import sys
+import hashlib
+import threading
+import optparse
+import BaseHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import vimcrypt
+
+
+class FakeDropbox(BaseHTTPServer.HTTPServer):
+    """HTTP server for the files in `corpus`
+
+    Files whose name (without extension) is in `private` are served
+    VimCrypt~01 encrypted with `key`. Files can be changed or removed
+    without touching `corpus` by edit().
+    """
+
+    def __init__(self, corpus, port=0, key=None, private=()):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, ('localhost', port), FakeDropboxHandler)
+        self.corpus = corpus
+        self.key = key
+        self.private = set(private)
+        self.edits = {}
+        self.requests = 0
+        self.not_modified = 0
+
+    def url_pattern(self):
+        """diary_url for a MyDropboxAccount using this server"""
+        return 'http://localhost:%d/%%s.txt' % self.server_address[1]
+
+    def edit(self, filename, content):
+        """Serve `content` for `filename` from now on; None removes it"""
+        self.edits[filename] = content
+
+    def content(self, filename):
+        """Return (content, etag) of a corpus file, or None if missing"""
+        if filename in self.edits:
+            content = self.edits[filename]
+            if content is None:
+                return None
+        else:
+            path = os.path.join(self.corpus, filename)
+            if not os.path.isfile(path):
+                return None
+            f = open(path, 'rb')
+            try:
+                content = f.read()
+            finally:
+                f.close()
+        if os.path.splitext(filename)[0] in self.private:
+            content = vimcrypt.vim_encrypt(content, self.key)
+        return content, hashlib.md5(content).hexdigest()
+
+    def start(self):
+        """Serve requests from a background thread"""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+
+
+class FakeDropboxHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.server.requests += 1
+        found = self.server.content(self.path.lstrip('/'))
+        if found is None:
+            self.send_error(404)
+            return
+        content, etag = found
+        if self.headers.get('If-None-Match') == etag:
+            self.server.not_modified += 1
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog CORPUS [options]')
+    parser.add_option('--port', type='int', default=8081)
+    parser.add_option('--key', help='encryption key for private pages')
+    parser.add_option('--private', default='',
+                      help='comma separated names of pages to encrypt')
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('no corpus directory given')
+    private = [name for name in options.private.split(',') if name]
+    if private and not options.key:
+        parser.error('--private needs --key')
+
+    server = FakeDropbox(args[0], options.port, options.key, private)
+    print 'serving %s as %s' % (args[0], server.url_pattern())
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
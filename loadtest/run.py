@@ -0,0 +1,241 @@
+"""Load test dropweb locally, without App Engine or a Dropbox account
+
+Runs the application from main.py in this process on top of the App Engine
+SDK's in-memory service stubs (datastore, memcache, users, urlfetch and
+task queue), with a FakeDropbox serving the pages. Reports latency
+percentiles and throughput for pages and the home page, cold (nothing
+stored or cached yet) and warm. Then edits, breaks and deletes a page each
+and checks that a bulk refresh (refresh_pages, as run by cron) handles them.
+
+    python run.py [--sdk PATH] [--corpus DIR | --pages N --size KB]
+                  [--private N] [--requests N] [--no-warmup]
+
+Comparing the first cold page view with and without --no-warmup shows what
+the warmup request saves.
+
+The SDK is looked for in $APPENGINE_SDK, or /usr/local/google_appengine.
+"""
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+import optparse
+import wsgiref.util
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+from fake_dropbox import FakeDropbox
+
+
+APP_ID = 'dropweb-loadtest'
+ENCRYPTION_KEY = 'loadtest'
+
+
+def setup_sdk(sdk):
+    sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    # the oldest Django in recent SDKs; the production runtime has 0.96
+    django = os.path.join(sdk, 'lib', 'django-1.2')
+    if os.path.isdir(django):
+        sys.path.insert(0, django)
+    os.environ.update(
+        APPLICATION_ID=APP_ID,
+        AUTH_DOMAIN='gmail.com',
+        SERVER_NAME='localhost',
+        SERVER_PORT='8080',
+        USER_EMAIL='',      # anonymous reader
+        USER_IS_ADMIN='0')
+
+
+def setup_stubs():
+    """Start over with empty in-memory App Engine services"""
+    from google.appengine.api import apiproxy_stub_map
+    from google.appengine.api import datastore_file_stub
+    from google.appengine.api import urlfetch_stub
+    from google.appengine.api import user_service_stub
+    from google.appengine.api.memcache import memcache_stub
+    from google.appengine.api.labs.taskqueue import taskqueue_stub
+
+    apiproxy_stub_map.apiproxy = stubs = apiproxy_stub_map.APIProxyStubMap()
+    stubs.RegisterStub('datastore_v3',
+                       datastore_file_stub.DatastoreFileStub(APP_ID, None, None))
+    stubs.RegisterStub('memcache', memcache_stub.MemcacheServiceStub())
+    stubs.RegisterStub('user', user_service_stub.UserServiceStub())
+    stubs.RegisterStub('urlfetch', urlfetch_stub.URLFetchServiceStub())
+    # queued tasks (page refreshes) are recorded but never run
+    stubs.RegisterStub('taskqueue',
+                       taskqueue_stub.TaskQueueServiceStub(root_path=ROOT))
+
+
+def make_corpus(directory, pages, size, private):
+    """Write `pages` Markdown pages of about `size` KB; return their names
+
+    Every third page is tagged 'tech'; the first `private` pages are to be
+    served encrypted.
+    """
+    paragraph = ('Lorem ipsum dolor sit amet, *consectetur* adipisicing '
+                 'elit, sed do [eiusmod](http://example.com/) tempor. ') * 8
+    names = []
+    for i in range(pages):
+        name = 'page%04d' % i
+        tags = i % 3 and 'diary' or 'tech, python'
+        body = ['Title: Page %d' % i,
+                'Tags: %s' % tags,
+                'DatePublished: Jan %d, 2010' % (i % 28 + 1),
+                '']
+        while sum([len(line) for line in body]) < size * 1024:
+            body.append('## Section %d\n\n%s\n' % (len(body), paragraph))
+        f = open(os.path.join(directory, name + '.txt'), 'w')
+        try:
+            f.write('\n'.join(body))
+        finally:
+            f.close()
+        names.append(name)
+    return names, names[:private]
+
+
+def request(app, path):
+    """GET `path` from the WSGI `app`; return the status code"""
+    environ = {'PATH_INFO': path, 'REQUEST_METHOD': 'GET', 'QUERY_STRING': ''}
+    wsgiref.util.setup_testing_defaults(environ)
+    status = []
+    body = []
+    def start_response(s, headers, exc_info=None):
+        status.append(s)
+        return body.append
+    body.extend(app(environ, start_response))
+    return int(status[0].split()[0])
+
+
+def measure(app, paths, before_each=None):
+    """Request each of `paths`; return the latency (seconds) of each"""
+    latencies = []
+    for path in paths:
+        if before_each is not None:
+            before_each()
+        start = time.time()
+        code = request(app, path)
+        latencies.append(time.time() - start)
+        # private pages redirect anonymous readers to the login page
+        if code >= 400:
+            raise RuntimeError('%s returned %d' % (path, code))
+    return latencies
+
+
+def report(label, latencies):
+    latencies = sorted(latencies)
+    def percentile(p):
+        return latencies[int(round(p * (len(latencies) - 1)))] * 1000
+    print '%-12s %6d %9.1f %9.1f %9.1f' % (
+        label, len(latencies), percentile(0.5), percentile(0.99),
+        len(latencies) / sum(latencies))
+
+
+def check_refresh(dropweb, dropbox, names):
+    """Refresh all pages after editing, breaking and deleting one each
+
+    Return the time (seconds) refresh_pages took.
+    """
+    edited, broken, deleted = names[-3:]
+    dropbox.edit(edited + '.txt', 'Title: Edited\nTags: diary\n\nEdited.\n')
+    # no Title meta
+    dropbox.edit(broken + '.txt', 'Not a diary page.\n')
+    dropbox.edit(deleted + '.txt', None)
+
+    start = time.time()
+    failed = dropweb.refresh_pages(names)
+    elapsed = time.time() - start
+
+    if sorted(failed) != sorted([broken, deleted]):
+        raise RuntimeError('refresh_pages failed on %r' % failed)
+    if failed[deleted] != 404:
+        raise RuntimeError('%s: %r, expected 404' % (deleted, failed[deleted]))
+    if dropweb.DropboxPublicPage.lookup(edited).title != 'Edited':
+        raise RuntimeError('%s was not updated' % edited)
+    if dropweb.DropboxPublicPage.lookup(broken) is None:
+        raise RuntimeError('%s was deleted' % broken)
+    key_name = dropweb.page_key_name(deleted)
+    if (dropweb.DropboxPublicPage.get_by_key_name(key_name) is not None or
+        dropweb.PageSummary.get_by_key_name(key_name) is not None):
+        raise RuntimeError('%s was not deleted' % deleted)
+    return elapsed
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--sdk', default=os.environ.get(
+        'APPENGINE_SDK', '/usr/local/google_appengine'))
+    parser.add_option('--corpus', help='directory of NAME.txt pages '
+                      '(default: generate --pages pages of --size KB)')
+    parser.add_option('--pages', type='int', default=50)
+    parser.add_option('--size', type='int', default=20)
+    parser.add_option('--private', type='int', default=5,
+                      help='number of generated pages to encrypt')
+    parser.add_option('--requests', type='int', default=500,
+                      help='number of requests for each warm run')
+    parser.add_option('--no-warmup', dest='warmup', action='store_false',
+                      default=True, help="don't send /_ah/warmup first")
+    options, args = parser.parse_args()
+
+    setup_sdk(options.sdk)
+    setup_stubs()
+    from google.appengine.api import memcache
+    start = time.time()
+    import main as dropweb
+    import_time = time.time() - start
+
+    tmpdir = None
+    if options.corpus:
+        names = [os.path.splitext(f)[0] for f in os.listdir(options.corpus)
+                 if f.endswith('.txt')]
+        private = []
+    else:
+        tmpdir = options.corpus = tempfile.mkdtemp()
+        names, private = make_corpus(tmpdir, options.pages, options.size,
+                                     options.private)
+    dropbox = FakeDropbox(options.corpus, key=ENCRYPTION_KEY, private=private)
+    dropbox.start()
+
+    try:
+        dropweb.MyDropboxAccount(diary_url=dropbox.url_pattern(),
+                                 encryption_key=ENCRYPTION_KEY).put()
+        dropweb.MyDropboxAccount.invalidate()
+        app = dropweb.application
+        public = [name for name in names if name not in private]
+        warm = [random.choice(public) for i in range(options.requests)]
+
+        print 'cold start: import main %.1f ms' % (import_time * 1000),
+        if options.warmup:
+            warmup_time = measure(app, ['/_ah/warmup'])[0]
+            print 'then /_ah/warmup %.1f ms' % (warmup_time * 1000)
+        else:
+            print '(no warmup request)'
+        print '%-12s %6s %9s %9s %9s' % (
+            'path', 'reqs', 'p50 ms', 'p99 ms', 'req/s')
+        # pages not stored yet: fetch, decrypt, convert, put and render
+        cold = measure(app, ['/' + name for name in names])
+        report('page cold', cold)
+        report('page warm', measure(app, ['/' + name for name in warm]))
+        report('/ cold', measure(app, ['/'] * 20, memcache.flush_all))
+        report('/ warm', measure(app, ['/'] * options.requests))
+        print 'first page view: %.1f ms' % (cold[0] * 1000)
+        if len(names) >= 3:
+            refresh_time = check_refresh(dropweb, dropbox, names)
+            print 'refresh_pages: %d pages in %.1f ms' % (
+                len(names), refresh_time * 1000),
+            print '(one each edited, broken and deleted)'
+        print 'fake dropbox: %d requests, %d not modified' % (
+            dropbox.requests, dropbox.not_modified)
+    finally:
+        dropbox.server_close()
+        if tmpdir:
+            shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,93 +1,335 @@
+import os
+import time
+import zlib
+import logging
+import bisect
+import hashlib
 from os import path
-from datetime import datetime
+from datetime import datetime, timedelta
 
 import markdown
+import vimcrypt
 
 from google.appengine.ext import webapp, db
 from google.appengine.ext.webapp import util
-from google.appengine.api.urlfetch import fetch
+from google.appengine.api import urlfetch
 from google.appengine.api import users
+from google.appengine.api import memcache
+from google.appengine.api.labs import taskqueue
 from google.appengine.ext.webapp import template
+from django.utils import simplejson
 
 
+# Pages validated against Dropbox within this window are served straight from
+# the datastore; revalidation happens at most once per window. SyncTask
+# revalidates all pages more often than this (see cron.yaml).
+FRESHNESS_TTL = timedelta(minutes=5)
+# How long (seconds) one request may hold a page's refresh to itself
+REFRESH_LOCK_TIMEOUT = 30
+# ... and how long (seconds) others wait on it when they have nothing to serve
+REFRESH_WAIT = 10
+# Number of fetches from dropbox in flight at the same time (for bulk
+# refreshes), and the time (seconds) each may take
+REFRESH_CONCURRENCY = 10
+FETCH_DEADLINE = 10
+# Rendered templates are cached per deployed version
+TEMPLATE_VERSION = os.environ.get('CURRENT_VERSION_ID', '')
+# Number of entities written per datastore call by bulk updates
+PUT_BATCH_SIZE = 50
+# Total size (characters) of rendered pages kept in each instance's memory
+RESPONSE_CACHE_SIZE = 4 * 1024 * 1024
+# Number of failed page fetches remembered by each instance, and how long
+# (seconds) they are answered without asking dropbox again
+NEGATIVE_CACHE_SIZE = 1000
+NEGATIVE_CACHE_TTL = 60
+
 class MyDropboxAccount(db.Model):
     
     diary_url = db.StringProperty(required=True) # 'http://dl.dropbox.com/u/87045/diary/%s.txt'
     encryption_key = db.StringProperty()
     
+    # process-wide cache of the one account, as (generation, account); see
+    # get() and invalidate()
+    _cached = None
+    # memcache key of the generation of the account, bumped by invalidate()
+    GENERATION_KEY = 'account-generation'
+    
     @staticmethod
     def get():
-        results = list(MyDropboxAccount.all())
-        if not results:
-            raise RuntimeError('no dropbox account setup')
-        elif len(results) == 1:
-            return results[0]
-        else:
-            raise RuntimeError('multiple accounts found')
+        generation = memcache.get(MyDropboxAccount.GENERATION_KEY)
+        cached = MyDropboxAccount._cached
+        if cached is None or cached[0] != generation:
+            results = list(MyDropboxAccount.all())
+            if not results:
+                raise RuntimeError('no dropbox account setup')
+            elif len(results) == 1:
+                MyDropboxAccount._cached = cached = (generation, results[0])
+            else:
+                raise RuntimeError('multiple accounts found')
+        return cached[1]
+    
+    @staticmethod
+    def invalidate():
+        """Forget the cached account; the next get() queries the datastore
+        
+        Applies to all instances: each notices the new generation on its
+        next get(). If memcache loses the generation, instances that cached
+        the account under another one query again too.
+        """
+        MyDropboxAccount._cached = None
+        memcache.set(MyDropboxAccount.GENERATION_KEY, int(time.time() * 1000))
+            
+
+def page_key_name(name):
+    """Datastore key name for the page called `name`"""
+    # key names may not start with a digit, hence the prefix
+    return 'page:%s' % name
+    
+
+class PageSummary(db.Model):
+    """Index fields of a DropboxPublicPage, without the content blobs
+    
+    Kept in sync by DropboxPublicPage._set_content so that the home page can
+    be built without loading every page body.
+    """
+    
+    name = db.StringProperty(required=True)
+    title = db.StringProperty()
+    tags = db.StringListProperty()
+    date_published = db.DateProperty()
+    is_private = db.BooleanProperty()
+    
+    @staticmethod
+    def from_page(page):
+        return PageSummary(
+            key_name=page_key_name(page.name),
+            name=page.name,
+            title=page.title,
+            tags=page.tags,
+            date_published=page.date_published,
+            is_private=page.is_private())
             
 
+# prefix of compressed values; values stored uncompressed (by older versions)
+# can't start with it as they are Markdown text or VimCrypt files
+ZLIB_MAGIC = '\0zlib\0'
+
+
+class StoredBlob(db.Blob):
+    """Blob read by CompressedBlobProperty, remembering its `stored` form"""
+    
+    
+class StoredText(db.Text):
+    """Text read by CompressedTextProperty, remembering its `stored` form"""
+    
+
+class CompressedBlobProperty(db.BlobProperty):
+    """BlobProperty stored zlib-compressed"""
+    
+    def get_value_for_datastore(self, model_instance):
+        value = super(CompressedBlobProperty, self).get_value_for_datastore(
+            model_instance)
+        if value is None:
+            return None
+        # a value unchanged since it was read needn't be compressed again
+        stored = getattr(value, 'stored', None)
+        if stored is not None:
+            return stored
+        return db.Blob(ZLIB_MAGIC + zlib.compress(value))
+        
+    def make_value_from_datastore(self, value):
+        if value is not None and value.startswith(ZLIB_MAGIC):
+            stored = value
+            value = StoredBlob(zlib.decompress(value[len(ZLIB_MAGIC):]))
+            value.stored = stored
+        return value
+        
+
+class CompressedTextProperty(db.TextProperty):
+    """TextProperty stored zlib-compressed (as a UTF-8 encoded blob)"""
+    
+    def get_value_for_datastore(self, model_instance):
+        value = super(CompressedTextProperty, self).get_value_for_datastore(
+            model_instance)
+        if value is None:
+            return None
+        stored = getattr(value, 'stored', None)
+        if stored is not None:
+            return stored
+        return db.Blob(ZLIB_MAGIC + zlib.compress(value.encode('utf-8')))
+        
+    def make_value_from_datastore(self, value):
+        if isinstance(value, db.Blob) and value.startswith(ZLIB_MAGIC):
+            stored = value
+            value = StoredText(zlib.decompress(value[len(ZLIB_MAGIC):]),
+                               'utf-8')
+            value.stored = stored
+        return value
+        
+
 class DropboxPublicPage(db.Model):
     
     name = db.StringProperty(required=True)
     
     # actual content of the file
-    data = db.BlobProperty()     
-    # decrypted content of the file (vim -x)
-    text = db.TextProperty()
+    data = CompressedBlobProperty()
+    # decrypted content of the file (vim -x); None if the file isn't
+    # encrypted, in which case it's the same as data. Use `text` to read it.
+    stored_text = CompressedTextProperty(name='text')
     # html version of text
-    html = db.TextProperty()
+    html = CompressedTextProperty()
     # dropbox etag for this url
     etag = db.StringProperty()
+    # sha1 of data, to tell a new etag for the same content
+    digest = db.StringProperty()
+    # last time the etag was checked against dropbox
+    last_validated = db.DateTimeProperty()
     
     # Meta information from Markdown
     title = db.StringProperty()
     tags = db.StringListProperty()
     date_published = db.DateProperty()
     
+    # PageSummary updated by _set_content, to be put along with the page
+    summary = None
+    
+    @staticmethod
+    def lookup(name):
+        """Return the stored DropboxPublicPage for `name`, or None"""
+        return DropboxPublicPage.get_by_key_name(page_key_name(name))
+    
     @staticmethod
     def get_page(name):
         """Return an instance of DropboxPublicPage for the given dropbox URL
         
         Transparently handle updating new copies from Dropbox, if any. This is
         done using the fact that Dropbox alters the URL etag if there is any
-        update to the content.
+        update to the content. Pages validated within FRESHNESS_TTL are
+        returned as stored, without contacting Dropbox.
         """
         acct = MyDropboxAccount.get()
-        url = acct.diary_url % name
+        page = DropboxPublicPage.lookup(name)
+        if page is None:
+            page = DropboxPublicPage(key_name=page_key_name(name), name=name)
         
-        results = list(DropboxPublicPage.all().filter('name =', name))
-        if not results:
-            page = DropboxPublicPage(name=name)
-        elif len(results) == 1:
-            page = results[0]
-        else:
-            raise RuntimeError, 'duplicate page objects for url: %s' % url
+        if not page.is_fresh():
+            try:
+                page = page.revalidate_once(acct)
+            except Exception, e:
+                # rather serve what we have than an error while dropbox is
+                # down (or the breaker says so)
+                if page.html is None or not is_dropbox_failure(e):
+                    raise
+                logging.warning('serving stored %s; dropbox failed: %r',
+                                name, e)
+        return page
+    
+    def revalidate_once(self, acct):
+        """revalidate(), unless another request is already refreshing this page
+        
+        Concurrent refreshes of a page are coalesced using a memcache lock (an
+        in-process registry would not help as each instance serves one
+        request at a time). Callers that lose the race get the stored copy
+        if there is one, or else wait for the winner to store its result.
+        """
+        lock = 'refresh-lock:%s' % self.name
+        if memcache.add(lock, 1, time=REFRESH_LOCK_TIMEOUT):
+            try:
+                self.revalidate(acct)
+            finally:
+                memcache.delete(lock)
+            return self
         
-        # refetch if etag was updated
-        if not page.etag or check_fetch(url, method='HEAD').headers['etag'] != page.etag:
-            response = check_fetch(url)
-            page._set_content(response.content, acct)
-            page.etag = response.headers['etag']
-            page.put()
+        if self.html is not None:
+            return self
         
+        deadline = time.time() + REFRESH_WAIT
+        while memcache.get(lock) is not None and time.time() < deadline:
+            time.sleep(0.1)
+        page = DropboxPublicPage.lookup(self.name)
+        if page is None or page.html is None:
+            # the other refresh failed; try ourselves
+            self.revalidate(acct)
+            return self
         return page
+    
+    def revalidate(self, acct):
+        """Check this page against Dropbox, updating content if it changed
+        
+        A page that is gone from Dropbox is deleted here as well.
+        """
+        try:
+            response = timer.time('fetch', check_fetch,
+                                  acct.diary_url % self.name,
+                                  headers=self.conditional_headers())
+        except FetchError, e:
+            if is_page_gone(e) and self.is_saved():
+                delete_pages([self.name])
+            raise
+        self.update(response, acct)
+        self.put_with_summary()
+        
+    def conditional_headers(self):
+        """Headers for a conditional GET of this page
+        
+        Dropbox replies 304 to it if the etag is unchanged.
+        """
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        return headers
+    
+    def update(self, response, acct):
+        """Update this page from the response to a conditional GET"""
+        if response.status_code != 304:
+            # dropbox may change the etag without the content changing
+            # (re-uploads, metadata changes); skip the work in that case
+            if content_digest(response.content) != self.digest:
+                self._set_content(response.content, acct)
+            self.etag = response.headers['etag']
+        self.last_validated = datetime.now()
+    
+    def put_with_summary(self):
+        """put() this page along with its updated PageSummary, if any"""
+        if self.summary is None:
+            timer.time('put', self.put)
+        else:
+            timer.time('put', db.put, [self, self.summary])
+            invalidate_index()
+    
+    def is_fresh(self):
+        """Was this page validated against Dropbox within FRESHNESS_TTL?"""
+        return bool(self.etag and self.last_validated and
+                    datetime.now() - self.last_validated < FRESHNESS_TTL)
+    
+    def staleness(self):
+        """Seconds since this page was last validated, or None if never"""
+        if not self.last_validated:
+            return None
+        age = datetime.now() - self.last_validated
+        return age.days * 86400 + age.seconds
       
     def _set_content(self, data, acct):
         """Set page content (raw)"""
+        old_index_fields = self.index_fields()
+        
         # decrypt vim encrypted file
-        if data.startswith('VimCrypt~01!'):
-            text = vim_decrypt(data, acct.encryption_key)
+        if data.startswith(vimcrypt.MAGIC):
+            text = timer.time('decrypt', vimcrypt.vim_decrypt,
+                              data, acct.encryption_key)
         else:
             text = data
             
         self.data = data
-        self.text = text
+        self.digest = content_digest(data)
+        if text is data:
+            self.stored_text = None
+        else:
+            self.stored_text = text
         
-        md = create_md()
-        self.html = md.convert(self.text)
+        self.html, meta = timer.time('convert', md_pool.convert, self.text)
         
         # update Meta
-        meta = md.Meta
         self.title = meta['title'][0]
         self.tags = meta['tags'][0].replace(',', ' ').split()
         if 'datepublished' in meta:
@@ -98,26 +340,519 @@ class DropboxPublicPage(db.Model):
             # wiki page, not a 'published' diary entry
             self.date_published = None
         
+        # the summary, and the cached home page, change only if the fields
+        # shown on the home page do
+        if self.index_fields() != old_index_fields:
+            self.summary = PageSummary.from_page(self)
+        
+    def index_fields(self):
+        return (self.title, self.tags, self.date_published, self.is_private())
+        
+    def _get_text(self):
+        if self.stored_text is None:
+            return self.data
+        return self.stored_text
+    text = property(_get_text)
+        
     def is_private(self):
         return self.text != self.data # vim encrypted?
     
     def md_convert(self):
-        md = create_md()
-        return md.convert(self.text), md.Meta
+        return md_pool.convert(self.text)
+    
+    
+def content_digest(data):
+    return hashlib.sha1(data).hexdigest()
     
     
 class FetchError(Exception):
     def __init__(self, response):
         self.response = response
         Exception.__init__(self)
-def check_fetch(*args, **kwargs):
-    """fetch() that raises exception on non-200 http codes"""
-    response = fetch(*args, **kwargs)
-    if response.status_code == 200:
+def check_fetch(url, headers={}):
+    """fetch() that raises exception on non-200 http codes
+    
+    304 (Not Modified) is not an error; it is the expected reply to a
+    conditional GET when the content hasn't changed. Raises CircuitOpenError
+    without fetching anything while `breaker` is open.
+    """
+    return breaker.call(
+        lambda: check_response(dropbox.fetch(url, headers)))
+    
+    
+def check_response(response):
+    """Raise FetchError unless `response` is a 200 or 304"""
+    if response.status_code in (200, 304):
         return response
     else:
         raise FetchError(response)
         
+        
+def is_page_gone(e):
+    """Did dropbox answer that the page was deleted (or unpublished)?"""
+    return isinstance(e, FetchError) and e.response.status_code in (404, 410)
+    
+    
+class CircuitOpenError(Exception):
+    """Dropbox is not being contacted, as it failed recently"""
+    
+    
+def is_dropbox_failure(e):
+    """Is the exception `e` a failure of dropbox itself?
+    
+    As opposed to, say, a 404 for a page that doesn't exist.
+    """
+    if isinstance(e, FetchError):
+        return e.response.status_code >= 500
+    return isinstance(e, (CircuitOpenError, urlfetch.Error))
+    
+    
+class CircuitBreaker(object):
+    """Stops calls to dropbox while it is failing or slow
+    
+    While closed, calls go through and the outcome and latency of the last
+    `window` of them are kept. Once there are `min_calls` of those, the
+    breaker opens if `max_error_rate` of them failed or their average
+    latency exceeds `max_latency` seconds. While open, calls fail with
+    CircuitOpenError right away. After `reset_timeout` seconds it half-opens
+    and lets a probe call through: it closes again if the probe succeeds
+    in time, and reopens otherwise.
+    """
+    
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+    
+    def __init__(self, window=20, min_calls=5, max_error_rate=0.5,
+                 max_latency=5.0, reset_timeout=30):
+        self.window = window
+        self.min_calls = min_calls
+        self.max_error_rate = max_error_rate
+        self.max_latency = max_latency
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.opened_at = None
+        self.recent = []        # (ok, seconds) of recent calls
+        self.rejected = 0
+        self.transitions = {}   # 'closed->open' etc. -> count
+        
+    def call(self, func):
+        """Return func(), unless the breaker is open"""
+        self.check()
+        start = time.time()
+        try:
+            result = func()
+        except Exception, e:
+            self.record(not is_dropbox_failure(e), time.time() - start)
+            raise
+        self.record(True, time.time() - start)
+        return result
+        
+    def check(self):
+        """Raise CircuitOpenError unless a call may be made now"""
+        if self.state == self.OPEN:
+            if time.time() - self.opened_at < self.reset_timeout:
+                self.rejected += 1
+                raise CircuitOpenError()
+            self._transition(self.HALF_OPEN)
+            
+    def record(self, ok, seconds):
+        """Record the outcome of a call"""
+        ok = ok and seconds <= self.max_latency
+        if self.state == self.HALF_OPEN:
+            if ok:
+                self.recent = []
+                self._transition(self.CLOSED)
+            else:
+                self._open()
+            return
+        
+        self.recent.append((ok, seconds))
+        del self.recent[:-self.window]
+        if len(self.recent) < self.min_calls:
+            return
+        failures = len([1 for ok, seconds in self.recent if not ok])
+        latency = sum([seconds for ok, seconds in self.recent]) / len(self.recent)
+        if (failures >= self.max_error_rate * len(self.recent) or
+            latency > self.max_latency):
+            self._open()
+            
+    def _open(self):
+        self.opened_at = time.time()
+        self._transition(self.OPEN)
+        
+    def _transition(self, state):
+        if state != self.state:
+            transition = '%s->%s' % (self.state, state)
+            logging.warning('dropbox circuit breaker: %s', transition)
+            self.transitions[transition] = self.transitions.get(transition, 0) + 1
+            self.state = state
+            
+    def stats(self):
+        stats = dict(state=self.state, rejected=self.rejected,
+                     recent_calls=len(self.recent),
+                     recent_failures=len([1 for ok, s in self.recent if not ok]))
+        for transition, count in self.transitions.items():
+            stats['transitions ' + transition] = count
+        return stats
+        
+breaker = CircuitBreaker()
+        
+        
+class DropboxClient(object):
+    """HTTP client through which all requests to dropbox are made
+    
+    Connections are owned by App Engine's urlfetch service, which keeps
+    them alive between calls; applications can't open their own sockets.
+    What can be configured here is how many fetches are in flight at once
+    (`pool_size`) and how long each may take (`deadline`, in seconds).
+    """
+    
+    def __init__(self, pool_size=REFRESH_CONCURRENCY, deadline=FETCH_DEADLINE):
+        self.pool_size = pool_size
+        self.deadline = deadline
+        self.requests = 0
+        self.not_modified = 0
+        self.errors = 0
+        self.bytes_received = 0
+        self.peak_in_flight = 0
+        
+    def fetch(self, url, headers={}):
+        """GET `url`, returning the urlfetch response"""
+        response, error = self.fetch_all([(url, headers)]).next()
+        if error is not None:
+            raise error
+        return response
+        
+    def fetch_all(self, requests):
+        """GET many urls concurrently, up to `pool_size` at a time
+        
+        `requests` is a sequence of (url, headers). Yield (response, error)
+        for each, in order; error is the urlfetch.Error raised by a failed
+        fetch, else None.
+        """
+        in_flight = []
+        for url, headers in requests:
+            if len(in_flight) >= self.pool_size:
+                yield self._result(in_flight.pop(0))
+            rpc = urlfetch.create_rpc(deadline=self.deadline)
+            urlfetch.make_fetch_call(rpc, url, headers=headers)
+            self.requests += 1
+            in_flight.append(rpc)
+            self.peak_in_flight = max(self.peak_in_flight, len(in_flight))
+        for rpc in in_flight:
+            yield self._result(rpc)
+            
+    def _result(self, rpc):
+        try:
+            response = rpc.get_result()
+        except urlfetch.Error, e:
+            self.errors += 1
+            return None, e
+        if response.status_code == 304:
+            self.not_modified += 1
+        self.bytes_received += len(response.content)
+        return response, None
+    
+    def stats(self):
+        return dict(
+            pool_size=self.pool_size,
+            deadline=self.deadline,
+            requests=self.requests,
+            not_modified=self.not_modified,
+            errors=self.errors,
+            bytes_received=self.bytes_received,
+            peak_in_flight=self.peak_in_flight)
+            
+dropbox = DropboxClient()
+        
+        
+def refresh_pages(names):
+    """Revalidate the named pages against dropbox, all at once
+    
+    The conditional GETs are made concurrently by `dropbox`, and the updated
+    pages are written in batches as their responses come in; pages gone
+    from dropbox are deleted.
+    Return a dict mapping the names of pages that could not be refreshed to
+    why: their http status (None if there was no response), or the exception
+    raised when updating them.
+    """
+    acct = MyDropboxAccount.get()
+    keys = [db.Key.from_path('DropboxPublicPage', page_key_name(name))
+            for name in names]
+    pages = []
+    for name, page in zip(names, DropboxPublicPage.get(keys)):
+        if page is None:
+            page = DropboxPublicPage(key_name=page_key_name(name), name=name)
+        pages.append(page)
+    
+    breaker.check()
+    failed = {}
+    pending = []
+    summaries_changed = False
+    gone = []
+    responses = dropbox.fetch_all([
+        (acct.diary_url % page.name, page.conditional_headers())
+        for page in pages])
+    for page in pages:
+        response, error = timer.time('fetch', responses.next)
+        if error is not None:
+            logging.warning('fetching %s failed: %r', page.name, error)
+            breaker.record(False, 0)
+            failed[page.name] = None
+            continue
+        breaker.record(response.status_code < 500, 0)
+        try:
+            check_response(response)
+        except FetchError, e:
+            failed[page.name] = response.status_code
+            if is_page_gone(e) and page.is_saved():
+                gone.append(page.name)
+        else:
+            try:
+                page.update(response, acct)
+            except Exception, e:
+                # e.g. missing or malformed meta; don't let one broken page
+                # keep all the others from being refreshed
+                logging.exception('updating %s failed', page.name)
+                failed[page.name] = e
+            else:
+                # pages that are unchanged (304) are written too, for their
+                # last_validated; their content isn't compressed again
+                pending.append(page)
+                if page.summary is not None:
+                    pending.append(page.summary)
+                    summaries_changed = True
+        # written as they come, so that a run cut short by the request
+        # deadline keeps what it did
+        if len(pending) >= PUT_BATCH_SIZE:
+            timer.time('put', db.put, pending)
+            pending = []
+    
+    if pending:
+        timer.time('put', db.put, pending)
+    if summaries_changed:
+        invalidate_index()
+    if gone:
+        delete_pages(gone)
+    return failed
+        
+    
+def delete_pages(names):
+    """Delete the named pages, e.g. once they are gone from dropbox
+    
+    Their summaries go too, and with them their links on the home page.
+    """
+    logging.info('deleting pages gone from dropbox: %s', ', '.join(names))
+    keys = []
+    for name in names:
+        keys.append(db.Key.from_path('DropboxPublicPage', page_key_name(name)))
+        keys.append(db.Key.from_path('PageSummary', page_key_name(name)))
+    for i in range(0, len(keys), PUT_BATCH_SIZE):
+        db.delete(keys[i:i + PUT_BATCH_SIZE])
+    invalidate_index()
+        
+    
+def queue_refresh(name):
+    """Queue a RefreshTask for `name`, unless one was queued recently"""
+    if memcache.add('refresh-queued:%s' % name, 1,
+                    time=REFRESH_LOCK_TIMEOUT):
+        taskqueue.add(url='/_tasks/refresh', params=dict(name=name))
+        
+    
+class PhaseTimer(object):
+    """Times the phases (fetch, decrypt, convert, put, render) of requests
+    
+    The time spent in each phase of the current request is logged as one
+    JSON record when the request ends (see `timed`), and added to this
+    instance's per-phase histograms.
+    """
+    
+    # upper bounds (seconds) of the histogram buckets; the last is unbounded
+    BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5]
+    
+    def __init__(self):
+        self.current = {}
+        self.histograms = {}
+        
+    def time(self, phase, func, *args, **kwargs):
+        """Call func(*args, **kwargs), recording the time it took to `phase`"""
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.record(phase, time.time() - start)
+            
+    def record(self, phase, seconds):
+        self.current[phase] = self.current.get(phase, 0) + seconds
+        histogram = self.histograms.get(phase)
+        if histogram is None:
+            histogram = self.histograms[phase] = [0] * (len(self.BUCKETS) + 1)
+        histogram[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+        
+    def flush(self, path, seconds):
+        """End the current request, logging its timings"""
+        logging.info('timings %s', simplejson.dumps(dict(
+            path=path,
+            total=round(seconds, 4),
+            phases=dict([(phase, round(t, 4))
+                         for phase, t in self.current.items()]))))
+        self.current = {}
+        
+    def stats(self):
+        """Histogram of each phase, as text"""
+        labels = ['<=%gs' % bound for bound in self.BUCKETS] + [
+            '>%gs' % self.BUCKETS[-1]]
+        return dict([
+            (phase, ' '.join(['%s:%d' % (label, count)
+                              for label, count in zip(labels, histogram)]))
+            for phase, histogram in self.histograms.items()])
+            
+timer = PhaseTimer()
+
+
+def timed(application):
+    """WSGI middleware ending each request's PhaseTimer record"""
+    def timed_application(environ, start_response):
+        start = time.time()
+        try:
+            return application(environ, start_response)
+        finally:
+            timer.flush(environ.get('PATH_INFO'), time.time() - start)
+    return timed_application
+    
+    
+class LRUCache(object):
+    """Mapping that evicts its least recently used entries when full
+    
+    Holds at most `max_size` worth of values, as measured by `sizeof` (the
+    total length of the values by default).
+    """
+    
+    # fields of the links in the doubly linked list kept in recency order
+    PREV, NEXT, KEY, VALUE = 0, 1, 2, 3
+    
+    def __init__(self, max_size, sizeof=len):
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.links = {}
+        # root.NEXT is the least, root.PREV the most recently used link
+        self.root = root = []
+        root[:] = [root, root, None, None]
+        
+    def __len__(self):
+        return len(self.links)
+        
+    def __contains__(self, key):
+        return key in self.links
+        
+    def get(self, key, default=None):
+        link = self.links.get(key)
+        if link is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._unlink(link)
+        self._append(link)
+        return link[self.VALUE]
+        
+    def set(self, key, value):
+        self.delete(key)
+        size = self.sizeof(value)
+        if size > self.max_size:
+            return
+        link = [None, None, key, value]
+        self._append(link)
+        self.links[key] = link
+        self.size += size
+        while self.size > self.max_size:
+            self.delete(self.root[self.NEXT][self.KEY])
+            
+    def delete(self, key):
+        link = self.links.pop(key, None)
+        if link is not None:
+            self._unlink(link)
+            self.size -= self.sizeof(link[self.VALUE])
+            
+    def stats(self):
+        return dict(entries=len(self), size=self.size,
+                    hits=self.hits, misses=self.misses)
+    
+    def _append(self, link):
+        last = self.root[self.PREV]
+        link[self.PREV], link[self.NEXT] = last, self.root
+        last[self.NEXT] = self.root[self.PREV] = link
+        
+    def _unlink(self, link):
+        prev, next = link[self.PREV], link[self.NEXT]
+        prev[self.NEXT], next[self.PREV] = next, prev
+        
+        
+# rendered page.html by (page name, content digest or dropbox etag,
+# DropwebRequestHandler.viewer())
+response_cache = LRUCache(RESPONSE_CACHE_SIZE)
+
+# (http status, expiry time) of recent failed fetches, by page name
+failed_fetches = LRUCache(NEGATIVE_CACHE_SIZE, sizeof=lambda value: 1)
+
+
+def recent_failure(name):
+    """Status of a fetch of `name` that failed within NEGATIVE_CACHE_TTL"""
+    cached = failed_fetches.get(name)
+    if cached is None:
+        return None
+    status, expires = cached
+    if time.time() >= expires:
+        failed_fetches.delete(name)
+        return None
+    return status
+    
+    
+TEMPLATE_DIR = path.join(path.dirname(__file__), 'templates')
+
+
+def render(tmplname, tmplargs):
+    return template.render(path.join(TEMPLATE_DIR, tmplname), tmplargs)
+        
+        
+def make_etag(*parts):
+    """Strong HTTP ETag identifying the given strings"""
+    md5 = hashlib.md5()
+    for part in parts:
+        if isinstance(part, unicode):
+            part = part.encode('utf-8')
+        md5.update(part + '\0')
+    return '"%s"' % md5.hexdigest()
+    
+    
+# memcache key of the home page generation, which invalidate_index() bumps
+INDEX_GENERATION_KEY = 'index-generation'
+
+
+def index_cache_key():
+    """memcache key of the rendered home page of the current generation
+    
+    A home page rendered from summaries read before an invalidation is
+    stored under the previous generation, where it is never looked up.
+    """
+    generation = memcache.get(INDEX_GENERATION_KEY)
+    if generation is None:
+        memcache.add(INDEX_GENERATION_KEY, new_index_generation())
+        generation = memcache.get(INDEX_GENERATION_KEY)
+    return 'index:%s:%s' % (TEMPLATE_VERSION, generation)
+
+
+def invalidate_index():
+    """Start a new generation of the home page; MainHandler rebuilds it"""
+    if memcache.incr(INDEX_GENERATION_KEY) is None:
+        memcache.add(INDEX_GENERATION_KEY, new_index_generation())
+        
+        
+def new_index_generation():
+    # from the clock, so that an evicted generation is never reused
+    return int(time.time() * 1000)
+    
     
 def create_md():
     return markdown.Markdown(extensions = [
@@ -126,12 +861,55 @@ def create_md():
       'meta'])
     
     
-def vim_decrypt(data, key):
-    zd = _ZipDecrypter(key)
-    return ''.join([zd(c) for c in data[12:]])
-
-
-
+class MarkdownPool(object):
+    """Markdown instances reused across conversions
+    
+    Building a Markdown instance loads its extensions and compiles all the
+    inline patterns, so instances are kept around and reset() between
+    documents instead. An instance is checked out of the pool for the
+    duration of a conversion, so concurrent conversions never share one.
+    """
+    
+    def __init__(self, factory):
+        self.factory = factory
+        self.idle = []
+        self.hits = 0
+        self.misses = 0
+        self.build_time = 0.0
+        
+    def convert(self, text):
+        """Return the html and Meta for Markdown `text`"""
+        try:
+            md = self.idle.pop()
+            self.hits += 1
+        except IndexError:
+            start = time.time()
+            md = self.factory()
+            self.build_time += time.time() - start
+            self.misses += 1
+        try:
+            # convert() skips the meta extension for blank documents; don't
+            # let them pick up the previous document's Meta
+            md.Meta = {}
+            return md.convert(text), md.Meta
+        finally:
+            md.reset()
+            self.idle.append(md)
+            
+    def stats(self):
+        """Hit rate and the construction time (seconds) saved by reuse"""
+        total = self.hits + self.misses
+        average = self.misses and self.build_time / self.misses or 0.0
+        return dict(
+            size=len(self.idle),
+            hits=self.hits,
+            misses=self.misses,
+            hit_rate=total and float(self.hits) / total or 0.0,
+            time_saved=self.hits * average)
+    
+md_pool = MarkdownPool(create_md)
+    
+    
 class DropwebRequestHandler(webapp.RequestHandler):
   
     def admin_only(self):
@@ -146,7 +924,43 @@ class DropwebRequestHandler(webapp.RequestHandler):
         else:
             return True
 
+    def viewer(self):
+        """Whom rendered pages are for: '' for anonymous readers"""
+        user = users.get_current_user()
+        if not user:
+            return ''
+        elif users.is_current_user_admin():
+            return 'admin:%s' % user.nickname()
+        else:
+            return 'user:%s' % user.nickname()
+        
+    def not_modified(self, etag, public=False):
+        """Send `etag` and caching headers; True if the client has it already
+        
+        If so, the response is turned into a 304 and nothing needs to be
+        rendered. `public` responses may be kept by shared caches for
+        FRESHNESS_TTL.
+        """
+        headers = self.response.headers
+        headers['ETag'] = etag
+        headers['Vary'] = 'Cookie'
+        if public:
+            headers['Cache-Control'] = 'public, max-age=%d' % (
+                FRESHNESS_TTL.days * 86400 + FRESHNESS_TTL.seconds)
+        else:
+            headers['Cache-Control'] = 'private, max-age=0'
+        
+        client_etags = [t.strip() for t in
+                        self.request.headers.get('If-None-Match', '').split(',')]
+        if etag in client_etags or '*' in client_etags:
+            self.response.set_status(304)
+            return True
+        return False
+        
     def render_template(self, tmplname, tmplargs):
+        self.response.out.write(self.render_string(tmplname, tmplargs))
+        
+    def render_string(self, tmplname, tmplargs):
         tmplargs['user'] = user = users.get_current_user()
         if user:
             tmplargs['authlink'] = (
@@ -157,11 +971,7 @@ class DropwebRequestHandler(webapp.RequestHandler):
                 'login',
                 users.create_login_url(self.request.uri))
             
-        self.response.out.write(
-            template.render(
-              path.join(path.dirname(__file__), 'templates', tmplname),
-              tmplargs)
-        )
+        return timer.time('render', render, tmplname, tmplargs)
         
         
 class DropboxAccountHandler(DropwebRequestHandler):
@@ -173,14 +983,161 @@ class DropboxAccountHandler(DropwebRequestHandler):
         key = self.request.get('encryption_key')
         acct = MyDropboxAccount(diary_url=url, encryption_key=key)
         acct.put()
+        MyDropboxAccount.invalidate()
         self.render_template('error.html', dict(
           msg = 'Set dropbox account details successfully'))
     
 
+class MigrateHandler(DropwebRequestHandler):
+    """One-off upgrade of pages stored by older versions of dropweb"""
+  
+    def get(self):
+        if not self.admin_only(): return
+        
+        # loaded up front, as the query could otherwise return the pages
+        # written below as well
+        stored = list(DropboxPublicPage.all())
+        keyed_by_name = set([page.name for page in stored
+                             if page.key().name() == page_key_name(page.name)])
+        pages = []
+        old_keys = []
+        for page in stored:
+            # stored uncompressed, with text duplicating data
+            if page.stored_text == page.data:
+                page.stored_text = None
+            
+            key_name = page_key_name(page.name)
+            if page.key().name() != key_name:
+                # stored before pages were keyed by name; move it over,
+                # unless it was fetched again since
+                old_keys.append(page.key())
+                if page.name in keyed_by_name:
+                    continue
+                # the constructor takes values by datastore property name
+                page = DropboxPublicPage(key_name=key_name, **dict(
+                    (prop.name, getattr(page, attr))
+                    for attr, prop in page.properties().items()))
+            pages.append(page)
+        
+        # rewriting compresses the content; pages stored before PageSummary
+        # existed don't have one
+        for i in range(0, len(pages), PUT_BATCH_SIZE):
+            batch = pages[i:i + PUT_BATCH_SIZE]
+            db.put(batch + [PageSummary.from_page(page) for page in batch])
+        for i in range(0, len(old_keys), PUT_BATCH_SIZE):
+            db.delete(old_keys[i:i + PUT_BATCH_SIZE])
+        invalidate_index()
+        self.render_template('error.html', dict(
+          msg = 'Migrated %d pages' % len(pages)))
+    
+
+def warm_up():
+    """Prime this instance's module-level state before it takes traffic
+    
+    Return the time (seconds) it took.
+    """
+    start = time.time()
+    # imports the Markdown extensions and puts an instance in the pool
+    md_pool.convert('Title: warmup\nTags: warmup\n\n## warmup\n')
+    # compiles the templates into webapp's template cache
+    for tmplname in os.listdir(TEMPLATE_DIR):
+        template.load(path.join(TEMPLATE_DIR, tmplname))
+    # builds the decryption tables
+    vimcrypt.vim_decrypt(vimcrypt.MAGIC + 'warmup', 'warmup')
+    try:
+        MyDropboxAccount.get()
+    except RuntimeError, e:
+        logging.warning('warmup: %s', e)
+    instance['warmup_time'] = time.time() - start
+    return instance['warmup_time']
+    
+# facts about this instance, for StatsHandler
+instance = dict(started=datetime.now(), warmup_time=None)
+    
+
+class WarmupHandler(webapp.RequestHandler):
+    """Warmup request, sent by App Engine before an instance gets traffic"""
+    
+    def get(self):
+        logging.info('warmed up in %.3f seconds', warm_up())
+        
+
+class PushRefreshHandler(DropwebRequestHandler):
+    """Refresh the given pages from dropbox right away
+    
+    For the machine editing the pages to call after a change, e.g.
+    /_admin/refresh?name=foo&name=bar, so that readers get the new content
+    without waiting for revalidation.
+    """
+  
+    def get(self):
+        if not self.admin_only(): return
+        
+        names = self.request.get_all('name')
+        for name in names:
+            # the page may have just been created
+            failed_fetches.delete(name)
+        try:
+            failed = refresh_pages(names)
+        except CircuitOpenError:
+            self.error(503)
+            self.render_template('error.html', dict(
+              msg='dropbox is failing; try again later'))
+            return
+        
+        if failed:
+            self.error(502)
+        self.render_template('error.html', dict(
+          msg='Refreshed %d pages; failed: %s' % (
+            len(names) - len(failed),
+            ', '.join(['%s (%s)' % item for item in failed.items()])
+            or 'none')))
+        
+    post = get
+    
+
+class StatsHandler(DropwebRequestHandler):
+    """Runtime statistics of this instance, as plain text"""
+  
+    def get(self):
+        if not self.admin_only(): return
+        
+        self.response.headers['Content-Type'] = 'text/plain'
+        out = self.response.out
+        for title, stats in [
+              ('instance', instance),
+              ('markdown pool', md_pool.stats()),
+              ('response cache', response_cache.stats()),
+              ('failed fetches cache', failed_fetches.stats()),
+              ('dropbox client', dropbox.stats()),
+              ('dropbox circuit breaker', breaker.stats()),
+              ('phase timings', timer.stats())]:
+            out.write('%s:\n' % title)
+            for key, value in sorted(stats.items()):
+                out.write('  %s: %s\n' % (key, value))
+    
+
 class MainHandler(DropwebRequestHandler):
   
     def get(self):
-        pages = [p for p in DropboxPublicPage.all() if not p.is_private()]
+        # the rendered page only varies by the login link for anonymous
+        # readers; cache it for them until some page summary changes
+        if users.get_current_user() is not None:
+            self.response.out.write(self.render_index())
+            return
+        
+        key = index_cache_key()
+        cached = memcache.get(key)
+        if cached is None:
+            html = self.render_index()
+            cached = (make_etag(html), html)
+            memcache.set(key, cached)
+        etag, html = cached
+        if not self.not_modified(etag, public=True):
+            self.response.out.write(html)
+        
+    def render_index(self):
+        pages = list(PageSummary.all().filter('is_private =', False))
         # sort by title, as not all pages have published_date
         pages.sort(key=lambda page: page.title)
         
@@ -197,92 +1154,124 @@ class MainHandler(DropwebRequestHandler):
             else:
                 general_posts['pages'].append(page)
         
-        self.render_template('main.html', dict(sections=sections))
+        return self.render_string('main.html', dict(sections=sections))
 
 
 class PageHandler(DropwebRequestHandler):
   
     def get(self, name):
+        page = DropboxPublicPage.lookup(name)
+        if page is not None and page.html is not None:
+            # stale-while-revalidate: serve the stored copy right away and
+            # leave the dropbox check to a task queue task
+            if not page.is_fresh():
+                queue_refresh(name)
+            staleness = page.staleness()
+            logging.info('serving %s (stale by %s seconds)', name, staleness)
+            if staleness is not None:
+                self.response.headers['X-Dropweb-Staleness'] = str(staleness)
+        else:
+            # don't let requests for missing pages (crawlers, typos) turn
+            # into a request to dropbox each
+            status = recent_failure(name)
+            if status is None:
+                try:
+                    page = DropboxPublicPage.get_page(name)
+                except FetchError, e:
+                    status = e.response.status_code
+                    failed_fetches.set(
+                        name, (status, time.time() + NEGATIVE_CACHE_TTL))
+                except CircuitOpenError:
+                    status = 503
+            if status is not None:
+                # error() clears the response, so it goes first
+                self.error(status)
+                self.render_template('error.html', dict(
+                  msg='non-200 status: %s' % status))
+                return
+            
+        if page.is_private():
+            if not self.admin_only():
+                return
+        
+        # the page only varies by its content and the login link; pages
+        # stored before digests existed fall back to the dropbox etag
+        content = page.digest or page.etag
+        viewer = self.viewer()
+        etag = make_etag(content, TEMPLATE_VERSION, viewer)
+        if self.not_modified(etag, public=not (viewer or page.is_private())):
+            return
+        
+        key = (name, content, viewer)
+        html = response_cache.get(key)
+        if html is None:
+            html = self.render_string('page.html', dict(page=page))
+            response_cache.set(key, html)
+        self.response.out.write(html)
+        
+
+class RefreshTask(webapp.RequestHandler):
+    """Revalidate a page against dropbox (queued by PageHandler)"""
+    
+    def post(self):
+        name = self.request.get('name')
         try:
-            page = DropboxPublicPage.get_page(name)
+            DropboxPublicPage.get_page(name)
         except FetchError, e:
-            html = 'non-200 status: %s' % e.response.status_code
-            self.render_template('error.html', dict(
-              msg='non-200 status: %s' % e.response.status_code))
-            self.error(e.response.status_code)
-        else:
-            if page.is_private():
-                if not self.admin_only():
-                    return
-            self.render_template('page.html', dict(page=page))
+            # the next reader will queue another attempt; don't let the
+            # task queue retry forever on a missing page
+            logging.warning('refreshing %s failed with status %s',
+                            name, e.response.status_code)
+        except CircuitOpenError:
+            logging.warning('not refreshing %s; dropbox circuit is open', name)
+        except Exception:
+            # e.g. the new content has no Title; retrying won't help, and
+            # readers keep getting the stored copy. Count the page as
+            # validated so that they don't queue another refresh for a while.
+            logging.exception('refreshing %s failed', name)
+            page = DropboxPublicPage.lookup(name)
+            if page is not None:
+                page.last_validated = datetime.now()
+                page.put()
      
 
-# copied from Python2.6's zipfile.py   
-class _ZipDecrypter:
-    """Class to handle decryption of files stored within a ZIP archive.
+class SyncTask(webapp.RequestHandler):
+    """Revalidate and re-render all known pages (run by cron, see cron.yaml)
+    
+    This way readers rarely wait on dropbox or on conversion, even for the
+    first hit after an edit.
+    """
+    
+    def get(self):
+        names = [summary.name for summary in PageSummary.all()]
+        try:
+            failed = refresh_pages(names)
+        except CircuitOpenError:
+            logging.warning('not syncing; dropbox circuit is open')
+            return
+        logging.info('refreshed %d pages; failed: %r',
+                     len(names) - len(failed), failed)
+     
 
-    ZIP supports a password-based form of encryption. Even though known
-    plaintext attacks have been found against it, it is still useful
-    to be able to get data out of such a file.
+ROUTES = [
+  ('/_ah/warmup', WarmupHandler),
+  ('/acct', DropboxAccountHandler),
+  ('/_admin/migrate', MigrateHandler),
+  ('/_admin/stats', StatsHandler),
+  ('/_admin/refresh', PushRefreshHandler),
+  ('/_tasks/refresh', RefreshTask),
+  ('/_tasks/sync', SyncTask),
+  ('/(.+)', PageHandler),
+  ('/', MainHandler),
+]
 
-    Usage:
-        zd = _ZipDecrypter(mypwd)
-        plain_char = zd(cypher_char)
-        plain_text = map(zd, cypher_text)
-    """
 
-    def _GenerateCRCTable():
-        """Generate a CRC-32 table.
+# built once per instance; App Engine keeps this module loaded between
+# requests and calls main() for each
+application = timed(webapp.WSGIApplication(ROUTES, debug=True))
 
-        ZIP encryption uses the CRC32 one-byte primitive for scrambling some
-        internal keys. We noticed that a direct implementation is faster than
-        relying on binascii.crc32().
-        """
-        poly = 0xedb88320
-        table = [0] * 256
-        for i in range(256):
-            crc = i
-            for j in range(8):
-                if crc & 1:
-                    crc = ((crc >> 1) & 0x7FFFFFFF) ^ poly
-                else:
-                    crc = ((crc >> 1) & 0x7FFFFFFF)
-            table[i] = crc
-        return table
-    crctable = _GenerateCRCTable()
-
-    def _crc32(self, ch, crc):
-        """Compute the CRC32 primitive on one byte."""
-        return ((crc >> 8) & 0xffffff) ^ self.crctable[(crc ^ ord(ch)) & 0xff]
-
-    def __init__(self, pwd):
-        self.key0 = 305419896
-        self.key1 = 591751049
-        self.key2 = 878082192
-        for p in pwd:
-            self._UpdateKeys(p)
-
-    def _UpdateKeys(self, c):
-        self.key0 = self._crc32(c, self.key0)
-        self.key1 = (self.key1 + (self.key0 & 255)) & 4294967295
-        self.key1 = (self.key1 * 134775813 + 1) & 4294967295
-        self.key2 = self._crc32(chr((self.key1 >> 24) & 255), self.key2)
-
-    def __call__(self, c):
-        """Decrypt a single character."""
-        c = ord(c)
-        k = self.key2 | 2
-        c = c ^ (((k * (k^1)) >> 8) & 255)
-        c = chr(c)
-        self._UpdateKeys(c)
-        return c
 
 def main():
-  application = webapp.WSGIApplication([
-    ('/acct', DropboxAccountHandler),
-    ('/(.+)', PageHandler),
-    ('/', MainHandler),
-  ], debug=True)
   util.run_wsgi_app(application)
 
 
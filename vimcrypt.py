@@ -0,0 +1,123 @@
+"""Decryption of files encrypted by vim -x (VimCrypt~01, i.e. PKZIP crypto)"""
+
+from array import array
+
+
+MAGIC = 'VimCrypt~01!'
+
+# decrypt() works on this many bytes at a time, bounding its working set
+CHUNK_SIZE = 64 * 1024
+
+
+def vim_decrypt(data, key):
+    """Decrypt the contents of a VimCrypt~01 file"""
+    return ''.join(iter_decrypt(data, key))
+
+
+def iter_decrypt(data, key, chunk_size=CHUNK_SIZE):
+    """Decrypt a VimCrypt~01 file, yielding the text in chunks"""
+    zd = _ZipDecrypter(key)
+    for start in xrange(len(MAGIC), len(data), chunk_size):
+        yield zd.decrypt(data[start:start + chunk_size])
+
+
+def vim_encrypt(text, key):
+    """Encrypt `text` the way vim -x does (the inverse of vim_decrypt)"""
+    zd = _ZipDecrypter(key)
+    cipher = []
+    for c in text:
+        k = zd.key2 | 2
+        cipher.append(chr(ord(c) ^ (((k * (k^1)) >> 8) & 255)))
+        zd._UpdateKeys(c)
+    return MAGIC + ''.join(cipher)
+
+
+# copied from Python2.6's zipfile.py
+class _ZipDecrypter:
+    """Class to handle decryption of files stored within a ZIP archive.
+
+    ZIP supports a password-based form of encryption. Even though known
+    plaintext attacks have been found against it, it is still useful
+    to be able to get data out of such a file.
+
+    Usage:
+        zd = _ZipDecrypter(mypwd)
+        plain_char = zd(cypher_char)
+        plain_text = map(zd, cypher_text)
+        plain_text = zd.decrypt(cypher_text) # much faster
+    """
+
+    def _GenerateCRCTable():
+        """Generate a CRC-32 table.
+
+        ZIP encryption uses the CRC32 one-byte primitive for scrambling some
+        internal keys. We noticed that a direct implementation is faster than
+        relying on binascii.crc32().
+        """
+        poly = 0xedb88320
+        table = [0] * 256
+        for i in range(256):
+            crc = i
+            for j in range(8):
+                if crc & 1:
+                    crc = ((crc >> 1) & 0x7FFFFFFF) ^ poly
+                else:
+                    crc = ((crc >> 1) & 0x7FFFFFFF)
+            table[i] = crc
+        return table
+    crctable = _GenerateCRCTable()
+
+    # keystream byte for each value of the low 16 bits of key2 (the only
+    # bits it depends on); built on first use of decrypt()
+    streamtable = None
+
+    def _crc32(self, ch, crc):
+        """Compute the CRC32 primitive on one byte."""
+        return ((crc >> 8) & 0xffffff) ^ self.crctable[(crc ^ ord(ch)) & 0xff]
+
+    def __init__(self, pwd):
+        self.key0 = 305419896
+        self.key1 = 591751049
+        self.key2 = 878082192
+        for p in pwd:
+            self._UpdateKeys(p)
+
+    def _UpdateKeys(self, c):
+        self.key0 = self._crc32(c, self.key0)
+        self.key1 = (self.key1 + (self.key0 & 255)) & 4294967295
+        self.key1 = (self.key1 * 134775813 + 1) & 4294967295
+        self.key2 = self._crc32(chr((self.key1 >> 24) & 255), self.key2)
+
+    def __call__(self, c):
+        """Decrypt a single character."""
+        c = ord(c)
+        k = self.key2 | 2
+        c = c ^ (((k * (k^1)) >> 8) & 255)
+        c = chr(c)
+        self._UpdateKeys(c)
+        return c
+
+    def decrypt(self, data):
+        """Decrypt a string; same result as ''.join(map(self, data))
+
+        This is __call__ and _UpdateKeys inlined into a single loop over
+        byte values, with the keystream byte looked up in streamtable.
+        """
+        streamtable = _ZipDecrypter.streamtable
+        if streamtable is None:
+            streamtable = _ZipDecrypter.streamtable = [
+                ((k * (k^1)) >> 8) & 255 for k in [k | 2 for k in xrange(65536)]]
+        crctable = self.crctable
+        key0, key1, key2 = self.key0, self.key1, self.key2
+
+        plain = []
+        append = plain.append
+        for c in array('B', data):
+            c ^= streamtable[key2 & 0xffff]
+            append(c)
+            key0 = (key0 >> 8) ^ crctable[(key0 ^ c) & 0xff]
+            key1 = ((key1 + (key0 & 255)) * 134775813 + 1) & 4294967295
+            key2 = (key2 >> 8) ^ crctable[(key2 ^ (key1 >> 24)) & 0xff]
+
+        self.key0, self.key1, self.key2 = key0, key1, key2
+        return array('B', plain).tostring()